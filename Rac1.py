@@ -28,10 +28,18 @@
 #  - subprocess
 #  - re
 #  - json
-#  - psutil
 #  - time
 #  - signal
 #  - os
+#  - errno
+#  - math
+#  - threading
+#  - collections
+#  - queue (Queue in Py2)
+#  - contextlib
+#  - array, mmap, struct (only for `Catalog`)
+#  - cProfile, pstats (only with `--profile`)
+#  - tracemalloc (only with `--profile`, Py3)
 #
 # Other dependencies:
 #  - mplayer (shell command)
@@ -44,9 +52,19 @@ import signal
 import re
 import json
 import unicodedata
+import os
+import errno
+import math
+import time
+import threading
+try:
+    import queue
+except ImportError:  # Py2
+    import Queue as queue
 import requests
 import configargparse
 import inspect
+from contextlib import contextmanager
 
 
 '''
@@ -211,6 +229,74 @@ class ParseArguments(object):
                             const=[],
                             help=("Neteja la llista d'exclusions definida fins el moment. "
                                   "No afecta posteriors entrades de '-x'."))
+        parser.add_argument("--follow",
+                            dest='follow',
+                            default=False,
+                            action="store_true",
+                            help=("Si el dia és avui, espera que es publiquin els programes "
+                                  "següents fins l'hora TO, en comptes d'acabar."))
+        parser.add_argument("--cache-max",
+                            dest='cache_max',
+                            metavar="KB",
+                            default=PlayerCommand.cache_max,
+                            type=int,
+                            action="store",
+                            help=("Mida màxima de la memòria cau del reproductor. "
+                                  "La mida i la precàrrega de cada podcast es calculen "
+                                  "segons la seva mida i la velocitat de descàrrega mesurada."))
+        parser.add_argument("--preflight",
+                            dest='preflight',
+                            default=False,
+                            action="store_true",
+                            help=("Comprova en segon pla que les URLs dels propers podcasts "
+                                  "funcionen abans d'escoltar-los, i descarta les que no."))
+        parser.add_argument("--preflight-ahead",
+                            dest='preflight_ahead',
+                            metavar="N",
+                            default=Preflight.ahead,
+                            type=int,
+                            action="store",
+                            help="Nombre de podcasts a comprovar alhora amb '--preflight'.")
+        parser.add_argument("--download",
+                            dest='download',
+                            metavar="DIR",
+                            default=None,
+                            action="store",
+                            help=("Descarrega els àudios dels podcasts al directori DIR "
+                                  "en comptes d'escoltar-los. Continua les descàrregues a mitges."))
+        parser.add_argument("--download-connections",
+                            dest='download_connections',
+                            metavar="N",
+                            default=Downloader.connections,
+                            type=int,
+                            action="store",
+                            help=("Nombre màxim de connexions simultànies amb '--download', "
+                                  "repartides entre els fitxers i els trossos de cada fitxer."))
+        parser.add_argument("--download-rate",
+                            dest='download_rate',
+                            metavar="KB/s",
+                            default=0,
+                            type=int,
+                            action="store",
+                            help=("Límit global de velocitat amb '--download'. "
+                                  "Amb 0 no hi ha límit."))
+        parser.add_argument("--prefetch",
+                            dest='prefetch',
+                            metavar="N",
+                            default=0,
+                            type=int,
+                            action="store",
+                            help=("Nombre de podcasts a tenir preparats en segon pla mentre "
+                                  "se n'escolta un, per no esperar entre programes. "
+                                  "Amb 0 es desactiva."))
+        parser.add_argument("--profile",
+                            dest='profile',
+                            metavar="DIR",
+                            default=None,
+                            action="store",
+                            help=("Perfila l'ús de CPU i memòria de cada fase "
+                                  "(filter, player, prefetch, preflight, download, main) "
+                                  "i desa els informes al directori DIR."))
 
         # Parse arguments
         args = parser.parse_args(argv)
@@ -271,32 +357,264 @@ class ExceptionPlayer(Exception):
         return self.message
 
 
-def get_page(host, path, https=False, message=u"Error downloading page"):
-    '''Downloads a page'''
+class ExceptionCancelled(Exception):
+    '''Work cancelled because the program is exiting'''
 
-    headers = {
-        'User-Agent': "https://github.com/emibcn/Rac1.py",
-        'Cache-Control': 'max-age=0',
-        'Connection': 'keep-alive',
-        'DNT': '1',
-        'Upgrade-Insecure-Requests': '1',
-    }
+    def __init__(self, message=u"Cancel·lat"):
+        self.message = message
+        super(ExceptionCancelled, self).__init__(message)
+
+    def __str__(self):
+        return self.message
+
+
+class Cancellation(object):
+    '''
+    Class to cancel all pending work when exiting: HTTP requests, background
+    threads and waits. Streamed responses can be registered to be aborted too.
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._responses = set()
+
+    @property
+    def cancelled(self):
+        '''Whether work has been cancelled'''
+        return self._event.is_set()
+
+    def cancel(self):
+        '''Cancels all work, closing registered responses'''
+
+        self._event.set()
+
+        with self._lock:
+            responses, self._responses = self._responses, set()
+
+        for response in responses:
+            response.close()
+
+    def reset(self):
+        '''Allows new work after a cancellation'''
+        self._event.clear()
+
+    def check(self):
+        '''Raises ExceptionCancelled if work has been cancelled'''
+        if self.cancelled:
+            raise ExceptionCancelled()
+
+    def wait(self, seconds):
+        '''Waits up to `seconds`, or less if cancelled. Returns whether it was cancelled'''
+        return self._event.wait(max(0, seconds))
+
+    @contextmanager
+    def tracking(self, response):
+        '''Context manager which closes a streamed response on exit, or on cancellation'''
+
+        with self._lock:
+            self._responses.add(response)
+
+        try:
+            self.check()
+            yield response
+
+        finally:
+            with self._lock:
+                self._responses.discard(response)
+            response.close()
+
+
+# Cancellation of all pending work
+cancellation = Cancellation()
+
+# HTTP (connect, read) timeouts in seconds
+HTTP_TIMEOUT = (5, 30)
+
+# HTTP headers sent on every request
+HTTP_HEADERS = {
+    'User-Agent': "https://github.com/emibcn/Rac1.py",
+    'Cache-Control': 'max-age=0',
+    'Connection': 'keep-alive',
+    'DNT': '1',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+
+def get_response(host, path, https=False, message=u"Error downloading page", headers=None):
+    '''
+    Downloads a page and returns the `requests` response.
+    Extra `headers` can make it conditional, so a 304 response is accepted too.
+    '''
+
+    cancellation.check()
 
     # Connect to server, send request and get response (and follow 3XX)
-    req = requests.get(
-        'http{secure}://{host}{path}'.format(
-            secure=('s' if https else ''),
-            host=host,
-            path=path),
-        headers=headers)
-
-    if req.status_code != 200:
+    try:
+        req = requests.get(
+            'http{secure}://{host}{path}'.format(
+                secure=('s' if https else ''),
+                host=host,
+                path=path),
+            headers=dict(HTTP_HEADERS, **(headers or {})),
+            timeout=HTTP_TIMEOUT)
+
+    except requests.RequestException as exc:
+        raise ExceptionDownloading("{message}: {error}".format(
+            message=message,
+            error=exc))
+
+    cancellation.check()
+
+    if req.status_code not in (200, 304):
         raise ExceptionDownloading("{message}: {code} - {error}".format(
             message=message,
             code=req.status_code,
             error=req.text))
 
-    return req.text
+    return req
+
+
+def get_page(host, path, https=False, message=u"Error downloading page"):
+    '''Downloads a page'''
+    return get_response(host, path, https=https, message=message).text
+
+
+def get_response_length(req):
+    '''Full resource length from a response, also for partial (206) ones'''
+
+    # Ranged responses contain the full length in `Content-Range: bytes 0-0/LENGTH`
+    content_range = req.headers.get('Content-Range', '')
+    if '/' in content_range and isint(content_range.split('/')[-1]):
+        return int(content_range.split('/')[-1])
+
+    if req.status_code == 200 and isint(req.headers.get('Content-Length', '')):
+        return int(req.headers['Content-Length'])
+
+    return None
+
+
+def probe_url(url, timeout=10):
+    '''
+    Checks an audio URL without downloading it, using HEAD or a 1 byte ranged GET.
+    Returns a dict with the keys `ok`, `status`, `latency` (seconds), `length` (bytes),
+    `ranges` (whether the server accepts ranged requests) and `error`
+    '''
+
+    result = {
+        'ok': False,
+        'status': None,
+        'latency': None,
+        'length': None,
+        'ranges': False,
+        'error': None,
+    }
+
+    start = time.time()
+    try:
+        req = requests.head(url, headers=HTTP_HEADERS, allow_redirects=True, timeout=timeout)
+
+        # Some servers don't implement HEAD or don't give length: ask for the first byte
+        if req.status_code != 200 or get_response_length(req) is None:
+            headers = dict(HTTP_HEADERS, Range='bytes=0-0')
+            req = requests.get(url, headers=headers, stream=True, timeout=timeout)
+            req.close()
+
+        result['latency'] = time.time() - start
+        result['status'] = req.status_code
+        result['ok'] = req.status_code in (200, 206)
+        result['length'] = get_response_length(req)
+        result['ranges'] = req.status_code == 206 or req.headers.get('Accept-Ranges') == 'bytes'
+
+    except requests.RequestException as exc:
+        result['latency'] = time.time() - start
+        result['error'] = str(exc)
+
+    return result
+
+
+class BandwidthMeter(object):
+    '''Class to keep a thread-safe moving average of the measured download throughput'''
+
+    # Weight of each new measure in the moving average
+    weight = 0.3
+
+    # Seconds after which measures are too old to be used:
+    # longer than a program, to not measure again between programs
+    max_age = 3 * 3600
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rate = None
+        self._time = None
+
+        # Held while a throughput probe runs, to not run several at once
+        self.measuring = threading.Lock()
+
+    def add(self, size, seconds):
+        '''Adds a measure of `size` bytes downloaded in `seconds`'''
+
+        if size <= 0 or seconds <= 0:
+            return
+
+        rate = size / float(seconds)
+        with self._lock:
+            if self._rate is None or self.is_stale():
+                self._rate = rate
+            else:
+                self._rate = self.weight * rate + (1 - self.weight) * self._rate
+            self._time = time.time()
+
+    def is_stale(self):
+        '''Whether there isn't any recent measure'''
+        return self._time is None or time.time() - self._time > self.max_age
+
+    @property
+    def rate(self):
+        '''Measured throughput in bytes per second, or None if unknown'''
+        return None if self.is_stale() else self._rate
+
+
+# Throughput measured by all downloads, to be used by players
+bandwidth = BandwidthMeter()
+
+
+def measure_throughput(url, size=256 * 1024, timeout=10):
+    '''
+    Measures download throughput by downloading the first `size` bytes of an URL.
+    Only ranged (206) responses are measured, so the full audio is never downloaded.
+    '''
+
+    headers = dict(HTTP_HEADERS, Range='bytes=0-{end}'.format(end=size - 1))
+
+    start = time.time()
+    req = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    with cancellation.tracking(req):
+        if req.status_code != 206:
+            return bandwidth.rate
+
+        downloaded = 0
+        for chunk in req.iter_content(64 * 1024):
+            downloaded += len(chunk)
+            if downloaded >= size:
+                break
+
+    bandwidth.add(downloaded, time.time() - start)
+    return bandwidth.rate
+
+
+def refresh_throughput(podcast):
+    '''Measures throughput with podcast audio if there isn't a recent measure'''
+
+    if bandwidth.rate is not None or not bandwidth.measuring.acquire(False):
+        return
+
+    try:
+        measure_throughput(podcast['path'])
+    except requests.RequestException as exc:
+        print(u"### No s'ha pogut mesurar la velocitat de descàrrega: {}".format(exc))
+    finally:
+        bandwidth.measuring.release()
 
 
 class Parser(object):
@@ -314,15 +632,18 @@ class Parser(object):
     def __init__(self, date):
         self.date = date
 
+        # Validators and UUIDs of the last downloaded first page, to detect changes
+        self._listing_validators = {}
+        self._listing_uuids = None
+
     def __call__(self):
         return self.get_podcasts()
 
-    def get_rac1_page(self, page=0):
-        '''Download HTML with audio UUIDs'''
+    def get_rac1_page_path(self, page=0):
+        '''Path of the HTML page with audio UUIDs'''
 
         # {date} must be in format DD/MM/YYYY
-        host = "www.rac1.cat"
-        path = ("/a-la-carta/cerca?"
+        return ("/a-la-carta/cerca?"
                 "text=&"
                 "programId=&"
                 "sectionId=HOUR&"
@@ -333,18 +654,51 @@ class Parser(object):
                     date=self.date,
                     page=page)
 
+    def get_rac1_page(self, page=0, headers=None):
+        '''Download HTML with audio UUIDs, or None if conditional `headers` say it didn't change'''
+
+        host = "www.rac1.cat"
+        path = self.get_rac1_page_path(page)
+
         print(u"### Descarreguem Feed HTML del llistat de Podcasts amb data {date}: {host}{path}"
               .format(
                   date=self.date,
                   host=host,
                   path=path))
 
-        data_raw = get_page(host, path, https=True,
-                            message=(u"Error intentant descarregar la pàgina HTML "
-                                     "amb el llistat de podcasts: "))
+        req = get_response(host, path, https=True, headers=headers,
+                           message=(u"Error intentant descarregar la pàgina HTML "
+                                    "amb el llistat de podcasts: "))
+
+        if req.status_code == 304:
+            return None
+
+        # Remember first page state, with the newest podcasts
+        if page == 0:
+            self._listing_validators = dict(
+                (header, req.headers[name])
+                for name, header in (('ETag', 'If-None-Match'),
+                                     ('Last-Modified', 'If-Modified-Since'))
+                if name in req.headers)
+            self._listing_uuids = list(self.parse_rac1_page(req.text, discard_pages=True)[0])
 
         # Return downloaded page
-        return data_raw
+        return req.text
+
+    def listing_changed(self):
+        '''
+        Whether the podcasts list has changed since it was last downloaded,
+        using a conditional request for its first page
+        '''
+
+        uuids = self._listing_uuids
+        if uuids is None:
+            return True
+
+        data_raw = self.get_rac1_page(headers=self._listing_validators)
+
+        # Not modified, or modified with the same podcasts
+        return data_raw is not None and self._listing_uuids != uuids
 
     def parse_rac1_page(self, data_raw, discard_pages=False):
         '''
@@ -456,6 +810,296 @@ class Parser(object):
             yield self.get_podcast_data(uuid)
 
 
+class Catalog(object):
+    '''
+    Compact binary snapshot of podcasts metadata, to be memory-mapped for fast loading.
+
+    The file contains a header, fixed-width columns (one value per podcast) and a
+    UTF-8 string table. Text columns are (offset, length) pairs into the string table.
+    Queries like `Filter` ones run on the columns; podcast dicts are only built for results.
+    '''
+
+    # File signature and header: signature, podcasts count, string table size
+    signature = b'RAC1CAT1'
+    header = '<8sII'
+
+    # Columns, in file order, with their `array` type code (little endian)
+    columns = (
+        ('date', 'I'),
+        ('duration', 'I'),
+        ('uuid', 'I'), ('uuid_len', 'I'),
+        ('title', 'I'), ('title_len', 'I'),
+        ('name', 'I'), ('name_len', 'I'),
+        ('path', 'I'), ('path_len', 'I'),
+        ('hour', 'B'),
+        ('minute', 'B'),
+    )
+
+    # Whether columns can be views of the mapped file: Py3 on little endian hosts
+    mapped_columns = sys.byteorder == 'little' and hasattr(memoryview, 'cast')
+
+    def __init__(self, path):
+        '''Memory-maps a catalog file'''
+
+        import mmap
+        import struct
+
+        with open(path, 'rb') as data:
+            self._mmap = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, self.count, strings_size = struct.unpack_from(self.header, self._mmap)
+        if signature != self.signature:
+            self._mmap.close()
+            raise ValueError(u"{path} is not a Rac1 catalog".format(path=path))
+
+        # Map columns
+        self._columns = {}
+        offset = struct.calcsize(self.header)
+        for name, typecode in self.columns:
+            size = self.count * self.itemsize(typecode)
+            self._columns[name] = self.get_column(offset, size, typecode)
+            offset += size
+
+        self._strings = offset
+        self._strings_end = offset + strings_size
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @staticmethod
+    def itemsize(typecode):
+        '''Bytes per value of a column type'''
+        return {'I': 4, 'B': 1}[typecode]
+
+    def get_column(self, offset, size, typecode):
+        '''Column values: a view of the mapped file if possible, or a copy'''
+
+        import array
+
+        if self.mapped_columns:
+            return memoryview(self._mmap)[offset:offset + size].cast(typecode)
+
+        # Py2 or big endian
+        column = array.array(typecode)
+        data = self._mmap[offset:offset + size]
+        if hasattr(column, 'frombytes'):
+            column.frombytes(data)
+        else:  # Py2
+            column.fromstring(data)
+        if sys.byteorder != 'little':
+            column.byteswap()
+        return column
+
+    def close(self):
+        '''Releases the mapped file'''
+
+        for column in self._columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        self._columns = {}
+        self._mmap.close()
+
+    @classmethod
+    def write(cls, path, podcasts):
+        '''Saves podcasts (as returned by `Parser`) into a catalog file. Returns podcasts count'''
+
+        import array
+        import struct
+
+        columns = dict((name, array.array(typecode)) for name, typecode in cls.columns)
+        strings = bytearray()
+
+        def add_string(name, value):
+            '''Appends a value to the string table and its position to the columns'''
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            columns[name].append(len(strings))
+            columns[name + '_len'].append(len(value))
+            strings.extend(value)
+
+        for podcast in podcasts:
+            audio = podcast['audio']
+            hour, minute = audio['time'].split(u':')[:2]
+
+            columns['date'].append(int(audio['date'].replace(u'-', u'')))
+            columns['duration'].append(int(podcast.get('durationSeconds') or 0))
+            columns['hour'].append(int(hour))
+            columns['minute'].append(int(minute))
+            add_string('uuid', audio['id'])
+            add_string('title', audio['title'])
+            add_string('name', normalize_encoding_upper(audio['title']))
+            add_string('path', podcast['path'])
+
+        count = len(columns['date'])
+        with open(path, 'wb') as output:
+            output.write(struct.pack(cls.header, cls.signature, count, len(strings)))
+            for name, _ in cls.columns:
+                if sys.byteorder != 'little':
+                    columns[name].byteswap()
+                columns[name].tofile(output)
+            output.write(bytes(strings))
+
+        return count
+
+    @classmethod
+    def export(cls, path, dates, parser_class=Parser):
+        '''Downloads podcasts of `dates` (DD/MM/YYYY) with `parser_class` and saves them'''
+
+        def podcasts():
+            '''All dates podcasts, without duplicates'''
+            uuids = set()
+            for date in dates:
+                for podcast in parser_class(date=date)():
+                    if podcast['audio']['id'] not in uuids:
+                        uuids.add(podcast['audio']['id'])
+                        yield podcast
+
+        return cls.write(path, podcasts())
+
+    def get_string(self, name, index):
+        '''Text column value for a podcast'''
+
+        start = self._strings + self._columns[name][index]
+        return self._mmap[start:start + self._columns[name + '_len'][index]].decode('utf-8')
+
+    def get_podcast(self, index):
+        '''Podcast dict, with the same keys used by `Filter` and players'''
+
+        date = self._columns['date'][index]
+        return {
+            'path': self.get_string('path', index),
+            'durationSeconds': self._columns['duration'][index],
+            'audio': {
+                'id': self.get_string('uuid', index),
+                'title': self.get_string('title', index),
+                'date': u'{:04d}-{:02d}-{:02d}'.format(
+                    date // 10000, date // 100 % 100, date % 100),
+                'time': u'{:02d}:{:02d}'.format(
+                    self._columns['hour'][index], self._columns['minute'][index]),
+                'hour': self._columns['hour'][index],
+            },
+        }
+
+    def query(self, date=None, from_hour=0, to_hour=23, excludes=()):
+        '''
+        Indexes of podcasts matching `Filter` criteria, without building podcast dicts:
+        - `date` as DD/MM/YYYY (all dates if None)
+        - Hours between `from_hour` and `to_hour`
+        - `excludes` as normalized by `ParseArguments`: hours or uppercase non-accented names
+        '''
+
+        dates = self._columns['date']
+        hours = self._columns['hour']
+        names = self._columns['name']
+        names_len = self._columns['name_len']
+
+        day = None if date is None else int(u''.join(date.split(u'/')[::-1]))
+        excluded_hours = set(int(exc) for exc in excludes if isint(exc))
+        excluded_names = [exc if isinstance(exc, bytes) else normalize_encoding_upper(exc)
+                          for exc in excludes if not isint(exc)]
+
+        for index in range(self.count):
+            hour = hours[index]
+            if (day is not None and dates[index] != day) or \
+                    not from_hour <= hour <= to_hour or \
+                    hour in excluded_hours:
+                continue
+
+            start = self._strings + names[index]
+            end = start + names_len[index]
+            if any(self._mmap.find(name, start, end) != -1 for name in excluded_names):
+                continue
+
+            yield index
+
+    def get_podcasts(self, date=None, from_hour=0, to_hour=23, excludes=()):
+        '''Generator for podcast dicts matching `query` criteria'''
+
+        for index in self.query(date, from_hour, to_hour, excludes):
+            yield self.get_podcast(index)
+
+
+class PublishPredictor(object):
+    '''
+    Class to predict when the next podcast will be published, learning the delay
+    between the end of the programs and their publication
+    '''
+
+    # Initial publish delay after the program end, in seconds
+    delay = 300
+
+    # Weight of each new measure in the delay moving average
+    weight = 0.5
+
+    # Delays longer than this are not new publications but archived ones
+    max_delay = 3 * 3600
+
+    # Expected duration of the next program
+    program_duration = 3600
+
+    # Seconds between listing polls once the expected publish time has passed
+    min_poll = 15
+    max_poll = 120
+
+    # Seconds late after the expected publish time before backing off polls
+    late_backoff = 600
+
+    @classmethod
+    def program_end(cls, podcast):
+        '''Local timestamp of the end of a podcast's program'''
+
+        start = time.mktime(time.strptime(
+            u'{date} {time}'.format(date=podcast['audio']['date'], time=podcast['audio']['time']),
+            '%Y-%m-%d %H:%M'))
+
+        return start + (podcast.get('durationSeconds') or cls.program_duration)
+
+    def poll_interval(self, late, errors=0):
+        '''
+        Seconds to wait before polling again when `late` seconds after the expected
+        publish time, backing off exponentially after long misses or on consecutive errors
+        '''
+
+        backoff = max(int(late // self.late_backoff), errors, 0)
+        return min(self.min_poll * 2 ** backoff, self.max_poll)
+
+    def learn(self, podcast, seen):
+        '''Learns the publish delay from a podcast detected at `seen` timestamp'''
+
+        delay = seen - self.program_end(podcast)
+        if 0 <= delay <= self.max_delay:
+            self.delay = self.weight * delay + (1 - self.weight) * self.delay
+
+    def expected(self, last_podcast, date, from_hour):
+        '''
+        Timestamp when the podcast following `last_podcast` is expected to be published.
+        Without last podcast, expect the one at `from_hour` of `date` (YYYY-MM-DD).
+        '''
+
+        if last_podcast is not None:
+            start = self.program_end(last_podcast)
+        else:
+            start = self.hour_start(date, from_hour)
+
+        return start + self.program_duration + self.delay
+
+    def deadline(self, date, to_hour):
+        '''Timestamp after which the `to_hour` program of `date` (YYYY-MM-DD) won't be published'''
+        return self.hour_start(date, to_hour) + self.program_duration + self.max_delay
+
+    @staticmethod
+    def hour_start(date, hour):
+        '''Local timestamp of an hour of `date` (YYYY-MM-DD)'''
+        return time.mktime(time.strptime(
+            u'{date} {hour:02d}'.format(date=date, hour=int(hour)), '%Y-%m-%d %H'))
+
+
 class Filter(object):
     '''Class to filter podcasts from Rac1 parser and re-download podcast feed if needed'''
 
@@ -471,6 +1115,8 @@ class Filter(object):
         start_first=0,
         only_print=False,
         only_print_url=False,
+        download=None,
+        follow=False,
     )
 
     def __init__(self, args=args, parser=None):
@@ -478,6 +1124,17 @@ class Filter(object):
         self.parser = parser if parser is not None else Parser(
             date=self.args.date)
 
+        # Last yielded podcast and publish time predictor, used when following
+        self._last_podcast = None
+        self.predictor = PublishPredictor()
+
+        # Optional callables to wait on before reloading the podcasts list, called with
+        # the number of yielded podcasts (see `Prefetcher`):
+        # - `before_reload`: before each reload
+        # - `before_recheck`: before a last reload, when the previous one found nothing new
+        self.before_reload = None
+        self.before_recheck = None
+
         # Generator initial state
         self._podcasts = self.get_autoreloaded_podcasts()
 
@@ -561,6 +1218,12 @@ class Filter(object):
         # before last podcast is listed there
         done_total = 0
 
+        # When following, time when new podcasts were detected
+        seen = None
+
+        # Whether a last reload has been done after a reload found nothing new
+        rechecked = False
+
         while True:
             # Get and yield list of podcasts:
             #  - Using human readable dates (already parsed at parse_args)
@@ -569,6 +1232,11 @@ class Filter(object):
             #  - Filtered by user provided options (done via filter_podcasts)
             #  - Discarding initial `done_total` podcasts
             done = 0
+
+            # Let consumers retrieving podcasts ahead catch up with the yielded ones
+            if done_total > 0 and self.before_reload is not None:
+                self.before_reload(done_total)
+
             try:
                 for i, podcast in enumerate(self.get_filtered_podcasts()):
 
@@ -576,6 +1244,11 @@ class Filter(object):
                     if i >= done_total:
                         done += 1
 
+                        # Learn publishing delay from podcasts appeared while following
+                        if seen is not None:
+                            self.predictor.learn(podcast, seen)
+                        self._last_podcast = podcast
+
                         # Yield podcast
                         yield podcast
 
@@ -593,30 +1266,688 @@ class Filter(object):
             # If anything was played, sum it to total
             if done > 0:
                 done_total += done
+                seen = None
+                rechecked = False
+
+            # If following today's podcasts, wait for new ones to be published
+            elif getattr(self.args, 'follow', False) and self.is_following():
+                seen = self.wait_for_new_podcasts()
+                if seen is None:
+                    break
+                continue
+
+            # If consumers reloaded ahead, check again once they need more podcasts,
+            # as it would have been reloaded without them
+            elif done_total > 0 and self.before_recheck is not None and not rechecked:
+                rechecked = True
+                self.before_recheck(done_total)
+                continue
 
             # If we couldn't play anything, don't try to download
             # the list again: there will be nothing, again
             else:
                 break
 
-            # If we are only printing URLs (again, we played nothing), stop trying, too
-            if self.args.only_print or self.args.only_print_url:
+            # If we are only printing URLs or downloading them (again, we played nothing),
+            # stop trying, too
+            if not getattr(self.args, 'follow', False) and \
+                    (self.args.only_print or self.args.only_print_url or
+                     getattr(self.args, 'download', None)):
                 break
 
+    def get_pending_hours(self):
+        '''Hours after the last yielded podcast, up to `to_hour`, not excluded by hour'''
+
+        first = self.args.from_hour if self._last_podcast is None else \
+            self._last_podcast['audio']['hour'] + 1
+        excluded = set(int(exc) for exc in self.args.excludes if isint(exc))
+
+        return [hour for hour in range(first, self.args.to_hour + 1) if hour not in excluded]
+
+    def is_following(self):
+        '''Whether new podcasts can still be published for the filtered date and hours'''
+
+        if self.args.date != time.strftime('%d/%m/%Y'):
+            return False
+
+        # Don't wait for programs which won't be published anymore (excluded, cancelled...)
+        date = u'-'.join(self.args.date.split(u'/')[::-1])
+        if time.time() > self.predictor.deadline(date, self.args.to_hour):
+            return False
+
+        return len(self.get_pending_hours()) > 0
+
+    def sleep(self, seconds):
+        '''Waits while following, unless cancelled'''
+        if cancellation.wait(seconds):
+            raise ExceptionCancelled()
+
+    def wait_for_new_podcasts(self):
+        '''
+        Waits until the podcasts list changes, polling it from the expected
+        publish time on, backing off on errors or long delays (see `PublishPredictor`).
+        Returns the time when changes were detected, or None if nothing can be published anymore.
+        '''
+
+        date = u'-'.join(self.args.date.split(u'/')[::-1])
+
+        # Don't wait beyond the moment when following stops
+        expected = min(
+            self.predictor.expected(self._last_podcast, date, self.args.from_hour),
+            self.predictor.deadline(date, self.args.to_hour))
+
+        if expected > time.time():
+            print(u"### Esperem el proper programa fins les {time}"
+                  .format(time=time.strftime('%H:%M:%S', time.localtime(expected))))
+            self.sleep(expected - time.time())
+
+        errors = 0
+        while self.is_following():
+            try:
+                if self.parser.listing_changed():
+                    return time.time()
+                errors = 0
+
+            # Keep following on listing errors, but don't insist on a failing server
+            except ExceptionDownloading as exc:
+                print(exc)
+                errors += 1
+
+            interval = self.predictor.poll_interval(time.time() - expected, errors)
+            print(u"### Encara no hi ha programes nous: tornem a mirar d'aquí {interval}s"
+                  .format(interval=interval))
+            self.sleep(interval)
+
+        return None
+
+
+class Prefetcher(object):
+    '''
+    Class to retrieve podcasts in a background thread, keeping a bounded queue
+    of them ready to be played. Errors raised retrieving podcasts are re-raised
+    to the consumer when it reaches them.
+
+    An autoreloading `Filter` is held before reloading its list until the consumer
+    dequeues the last podcast (starts playing it), so reloads don't happen between
+    programs. If that reload finds nothing new, a last one is done once the consumer
+    asks for a podcast after it, as it would happen without prefetching.
+
+    Prefetchers can be chained: the hooks are then passed on to the last one.
+    '''
+
+    # Maximum number of podcasts retrieved ahead of the consumer
+    size = 1
+
+    # Profiler phase of the background work
+    phase = 'prefetch'
+
+    # Seconds between checks for shutdown while waiting on the queue
+    poll_interval = 0.1
+
+    def __init__(self, podcasts, size=size, throughput=False, profiler=None):
+        self.podcasts = podcasts
+        self.size = max(1, size)
+
+        # Whether to measure throughput for players in background
+        self.throughput = throughput
+
+        # Profiler for the background work
+        self.profiler = profiler if profiler is not None else Profiler()
+
+        self._queue = queue.Queue(maxsize=self.size)
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Set while the consumer waits on an empty queue
+        self._waiting = threading.Event()
+
+        # Podcasts dequeued by the consumer
+        self._dequeued = 0
+
+        # Hooks of a chained consumer prefetcher, see `Filter`
+        self.before_reload = None
+        self.before_recheck = None
+
+        # Hold Filter reloads until the consumer catches up
+        if hasattr(podcasts, 'before_reload'):
+            podcasts.before_reload = self.wait_dequeued
+            podcasts.before_recheck = self.wait_drained
+
+        # Generator initial state
+        self._podcasts = self.get_prefetched_podcasts()
+
+    #
+    # Generator Implementation
+    #
+
+    def __next__(self):
+        return next(self._podcasts)
+
+    def next(self):
+        '''Py2 next() generator implementation'''
+        return self.__next__()
+
+    def __iter__(self):
+        return self
+
+    #
+    # Methods
+    #
+
+    def put(self, kind, value=None):
+        '''Waits for room in the queue to put an item, unless closed. Returns whether it was put'''
+
+        while not self.stopped:
+            try:
+                self._queue.put((kind, value), timeout=self.poll_interval)
+
+                # Consumer will be waiting again only once it empties the queue
+                self._waiting.clear()
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce(self):
+        '''Background thread: retrieve podcasts and queue them'''
+
+        with self.profiler.phase(self.phase):
+            try:
+                for podcast in self.podcasts:
+                    if not self.put('podcast', self.prepare(podcast)):
+                        return
+
+            # Propagate any error to the consumer
+            except Exception as exc:  # pylint: disable=broad-except
+                self.put('error', exc)
+                return
+
+            self.put('done')
+
+    def prepare(self, podcast):
+        '''Background thread: prepares a podcast before queueing it'''
+
+        if self.throughput:
+            refresh_throughput(podcast)
+
+        return podcast
+
+    @property
+    def stopped(self):
+        '''Whether background retrieval has to stop'''
+        return self._stop.is_set() or cancellation.cancelled
+
+    def wait_dequeued(self, count):
+        '''Background thread: waits until the consumer has dequeued `count` podcasts'''
+
+        if self.before_reload is not None:
+            return self.before_reload(count)
+
+        while not self.stopped and self._dequeued < count:
+            self._stop.wait(self.poll_interval)
+
+    def wait_drained(self, count):
+        '''Background thread: waits until the consumer asks for more than `count` podcasts'''
+
+        if self.before_recheck is not None:
+            return self.before_recheck(count)
+
+        while not self.stopped and not (self._dequeued >= count and self._waiting.is_set()):
+            self._stop.wait(self.poll_interval)
+
+    def close(self):
+        '''Stops background retrieval as soon as possible'''
+        self._stop.set()
+
+    def get_prefetched_podcasts(self):
+        '''Generator for podcasts retrieved in background'''
+
+        self._thread = threading.Thread(target=self.produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+        try:
+            while True:
+
+                try:
+                    kind, value = self._queue.get_nowait()
+
+                except queue.Empty:
+                    # Let the producer know we are waiting for more
+                    self._waiting.set()
+
+                    # Use a timeout to let signals be handled while waiting (Py2)
+                    try:
+                        kind, value = self._queue.get(timeout=self.poll_interval)
+                    except queue.Empty:
+                        cancellation.check()
+                        continue
+
+                self._waiting.clear()
+
+                if kind == 'done':
+                    break
+
+                if kind == 'error':
+                    raise value
+
+                self._dequeued += 1
+                yield value
+
+        finally:
+            self.close()
+
+
+class Preflight(Prefetcher):
+    '''
+    Class to check upcoming podcasts audio URLs in background, skipping the broken ones.
+    Podcasts are retrieved and held like with `Prefetcher`.
+    '''
+
+    # Number of podcasts checked concurrently ahead of the one being yielded
+    ahead = 3
+
+    # Seconds to wait for each audio URL check
+    timeout = 10
+
+    # Profiler phase of the background work
+    phase = 'preflight'
+
+    def __init__(self, podcasts, ahead=ahead, timeout=timeout, throughput=False, profiler=None):
+        self.timeout = timeout
+        super(Preflight, self).__init__(
+            podcasts, size=ahead, throughput=throughput, profiler=profiler)
+        self.ahead = self.size
+
+        # Generator initial state
+        self._podcasts = self.get_checked_podcasts()
+
+    #
+    # Methods
+    #
+
+    def prepare(self, podcast):
+        '''Background thread: starts checking podcast audio URL in another thread'''
+
+        result = {}
+
+        def check():
+            '''Save URL probe results to be read once the thread has finished'''
+            with self.profiler.phase(self.phase):
+                result.update(probe_url(podcast['path'], timeout=self.timeout))
+
+                if self.throughput and result['ok']:
+                    refresh_throughput(podcast)
+
+        thread = threading.Thread(target=check)
+        thread.daemon = True
+        thread.start()
+
+        return podcast, thread, result
+
+    def get_checked_podcasts(self):
+        '''Generator for podcasts with a working audio URL'''
+
+        for podcast, thread, result in self.get_prefetched_podcasts():
+
+            # Wait for podcast check to finish
+            thread.join()
+
+            if result['ok']:
+                # Let the player know the measured audio size and latency
+                podcast['preflight'] = result
+                yield podcast
+
+            else:
+                print(u'### Descartem "{title}" {hour}h, no es pot descarregar '
+                      '({error}, {latency:.2f}s): {path}'
+                      .format(
+                          title=podcast['audio']['title'],
+                          hour=podcast['audio']['hour'],
+                          error=result['error'] or result['status'],
+                          latency=result['latency'] or 0,
+                          path=podcast['path']
+                      ))
+
+
+class RateLimiter(object):
+    '''Class to limit the bandwidth shared by several threads'''
+
+    def __init__(self, rate):
+        # Bytes per second
+        self.rate = float(rate)
+
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, amount):
+        '''Waits until `amount` bytes can be transferred within the rate limit'''
+
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + amount / self.rate
+
+        if start > now:
+            time.sleep(start - now)
+
+
+class Downloader(object):
+    '''
+    Class to download Rac1 podcasts audio files into a directory.
+
+    Each file is split into segments downloaded in parallel with HTTP Range requests
+    into `.part{start}-{end}of{length}` files, which let interrupted downloads be resumed,
+    and which are joined once complete. Parts from a different plan (other connections
+    count or remote length) are discarded. All files share the same connections and
+    bandwidth limits.
+    '''
+
+    # Maximum simultaneous HTTP connections, for all files
+    connections = 4
+
+    # Minimum segment size, to not split small files
+    segment_size = 4 * 1024 * 1024
+
+    # Bytes read at once from the connection
+    chunk_size = 64 * 1024
+
+    # Seconds to wait for the server (connect, read)
+    timeout = HTTP_TIMEOUT
+
+    # Plausible audio bitrates, in kbps, to verify downloaded length against podcast duration
+    bitrates = (16, 512)
+
+    # Arguments to customize behaviour
+    args = configargparse.Namespace(
+        download='.',
+        download_connections=connections,
+        download_rate=0,
+    )
+
+    def __init__(self, args=args, profiler=None):
+        self.args = args
+        self.directory = args.download
+        self.connections = max(1, args.download_connections)
+        self.limiter = RateLimiter(args.download_rate * 1024) if args.download_rate > 0 else None
+
+        # Profiler for the workers
+        self.profiler = profiler if profiler is not None else Profiler()
+
+        self._lock = threading.Lock()
+        self._errors = []
+
+    @classmethod
+    def plan_segments(cls, length, connections, segment_size=segment_size):
+        '''List of (start, end) inclusive byte ranges to download `length` bytes'''
+
+        count = max(1, min(connections, length // segment_size))
+        size = int(math.ceil(length / float(count)))
+
+        return [(start, min(start + size, length) - 1) for start in range(0, length, size)]
+
+    def filename(self, podcast):
+        '''Local file path for a podcast: date, hour and original file name'''
+
+        try:
+            from urllib.parse import urlparse
+        except ImportError:  # Py2
+            from urlparse import urlparse
+
+        return os.path.join(self.directory, u'{date}_{hour:02d}h_{name}'.format(
+            date=podcast['audio']['date'],
+            hour=podcast['audio']['hour'],
+            name=os.path.basename(urlparse(podcast['path']).path)))
+
+    def prepare(self, podcast):
+        '''Checks a podcast audio and returns its download state, or None if already downloaded'''
+
+        path = self.filename(podcast)
+        probe = probe_url(podcast['path'], timeout=self.timeout)
+
+        if not probe['ok']:
+            raise ExceptionDownloading(u"Error intentant descarregar {path}: {error}".format(
+                path=podcast['path'],
+                error=probe['error'] or probe['status']))
+
+        length = probe['length']
+
+        if os.path.exists(path) and length is not None and os.path.getsize(path) == length:
+            print(u'### Ja descarregat "{title}" {hour}h: {path}'.format(
+                title=podcast['audio']['title'],
+                hour=podcast['audio']['hour'],
+                path=path))
+            return None
+
+        # Without known length or ranges support, download it all with one connection
+        if not length or not probe['ranges']:
+            segments = [(0, None)]
+        else:
+            segments = self.plan_segments(length, self.connections, self.segment_size)
+
+        state = {
+            'podcast': podcast,
+            'path': path,
+            'length': length,
+            'segments': segments,
+            'pending': len(segments),
+            'start': time.time(),
+        }
+
+        # Discard parts of previous downloads with another plan: their content would
+        # be appended at the wrong offsets
+        parts = set(os.path.basename(self.part_path(state, index))
+                    for index in range(len(segments)))
+        prefix = os.path.basename(path) + u'.part'
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name not in parts:
+                os.remove(os.path.join(self.directory, name))
+
+        print(u'### Descarreguem "{title}" {hour}h en {count} trossos: {path}'.format(
+            title=podcast['audio']['title'],
+            hour=podcast['audio']['hour'],
+            count=len(segments),
+            path=path))
+
+        return state
+
+    @staticmethod
+    def part_path(state, index):
+        '''Segment file path, identifying its byte range and the full length'''
+
+        start, end = state['segments'][index]
+        if end is None:
+            return u'{path}.part'.format(path=state['path'])
+
+        return u'{path}.part{start}-{end}of{length}'.format(
+            path=state['path'],
+            start=start,
+            end=end,
+            length=state['length'])
+
+    def download_segment(self, state, index):
+        '''Downloads (or resumes) a segment into its part file'''
+
+        start, end = state['segments'][index]
+        part = self.part_path(state, index)
+        done = os.path.getsize(part) if os.path.exists(part) else 0
+
+        if end is not None and start + done > end:
+            return
+
+        headers = dict(HTTP_HEADERS)
+        if end is not None:
+            headers['Range'] = 'bytes={start}-{end}'.format(start=start + done, end=end)
+
+        # Without ranges we can't resume
+        else:
+            done = 0
+
+        cancellation.check()
+        req = requests.get(state['podcast']['path'], headers=headers,
+                           stream=True, timeout=self.timeout)
+        with cancellation.tracking(req):
+            if req.status_code not in (200, 206) or \
+                    ('Range' in headers and req.status_code != 206):
+                raise ExceptionDownloading(u"Error descarregant {path}: {code}".format(
+                    path=state['podcast']['path'],
+                    code=req.status_code))
+
+            started, downloaded = time.time(), 0
+            with open(part, 'ab' if done else 'wb') as output:
+                for chunk in req.iter_content(self.chunk_size):
+                    if self.limiter is not None:
+                        self.limiter.consume(len(chunk))
+                    output.write(chunk)
+                    downloaded += len(chunk)
+                    cancellation.check()
+
+            # Let players know the throughput of a single connection
+            bandwidth.add(downloaded, time.time() - started)
+
+    def assemble(self, state):
+        '''Joins segments into the final file and verifies its length'''
+
+        import shutil
+
+        parts = [self.part_path(state, index) for index in range(len(state['segments']))]
+        length = sum(os.path.getsize(part) for part in parts)
+
+        if state['length'] is not None and length != state['length']:
+            # Discard corrupted segments, so they will be downloaded again
+            for part in parts:
+                os.remove(part)
+
+            raise ExceptionDownloading(
+                u"Error descarregant {path}: {length} bytes en comptes de {expected}".format(
+                    path=state['podcast']['path'],
+                    length=length,
+                    expected=state['length']))
+
+        with open(state['path'], 'wb') as output:
+            for part in parts:
+                with open(part, 'rb') as segment:
+                    shutil.copyfileobj(segment, output)
+                os.remove(part)
+
+        # Duration is informative: only warn about lengths not matching it
+        seconds = state['podcast'].get('durationSeconds') or 0
+        if seconds > 0:
+            bitrate = length * 8 / 1000. / seconds
+            if not self.bitrates[0] <= bitrate <= self.bitrates[1]:
+                print(u'### Atenció: {path} fa {length} bytes, {bitrate:.0f} kbps per '
+                      '{seconds} segons'.format(
+                          path=state['path'],
+                          length=length,
+                          bitrate=bitrate,
+                          seconds=seconds))
+
+        elapsed = max(time.time() - state['start'], 0.001)
+        print(u'### Descarregat {path}: {size:.1f} MB a {speed:.0f} KB/s'.format(
+            path=state['path'],
+            size=length / 1024. / 1024.,
+            speed=length / 1024. / elapsed))
+
+    def work(self, tasks):
+        '''Worker thread: download segments from the tasks queue, profiled as `download` phase'''
+
+        with self.profiler.phase('download'):
+            self.work_tasks(tasks)
+
+    def work_tasks(self, tasks):
+        '''Worker thread: download segments from the tasks queue until a None is found'''
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+
+            state, index = task
+            try:
+                self.download_segment(state, index)
+
+                with self._lock:
+                    state['pending'] -= 1
+                    last = state['pending'] == 0
+
+                if last:
+                    self.assemble(state)
+
+            except ExceptionCancelled:
+                return
+
+            except (ExceptionDownloading, requests.RequestException, IOError) as exc:
+                print(exc)
+                with self._lock:
+                    self._errors.append(exc)
+
+    def download_podcasts(self, podcasts):
+        '''Downloads all podcasts, while the next ones are still being retrieved'''
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        tasks = queue.Queue()
+        workers = [threading.Thread(target=self.work, args=(tasks,))
+                   for _ in range(self.connections)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        for podcast in podcasts:
+            try:
+                state = self.prepare(podcast)
+            except ExceptionDownloading as exc:
+                print(exc)
+                with self._lock:
+                    self._errors.append(exc)
+                continue
+
+            if state is not None:
+                for index in range(len(state['segments'])):
+                    tasks.put((state, index))
+
+        for _ in workers:
+            tasks.put(None)
+
+        # Join with a timeout to let signals be handled (Py2)
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.5)
+
+        if self._errors:
+            raise ExceptionDownloading(u"No s'han pogut descarregar {count} fitxers".format(
+                count=len(self._errors)))
+
 
 class PlayerCommand(object):
     '''Class to play Rac1 podcasts with external command'''
 
     command_name = "Virtual Player"
 
-    # Player PID
+    # Player process (subprocess.Popen)
     _process = None
     _process_already_exiting = False
 
+    # Seconds to let the player exit on its own before killing it
+    shutdown_deadline = 2
+
+    # Background throughput measure thread (threading.Thread)
+    _throughput_thread = None
+
+    # Maximum player cache size in KB
+    cache_max = 16384
+
+    # Throughput margin over audio bitrate to consider a link fast enough
+    # to play without pre-buffering
+    throughput_margin = 1.2
+
     # Arguments to customize behaviour
     args = configargparse.Namespace(
         only_print=False,
         only_print_url=False,
+        cache_max=cache_max,
     )
 
     def __init__(self, args=args):
@@ -631,9 +1962,95 @@ class PlayerCommand(object):
         raise NotImplementedError((u"Subclass should implement command "
                                    "arguments creation as a `@classmethod`."))
 
+    @classmethod
+    def audio_size(cls, podcast):
+        '''
+        Podcast audio size in bytes: the length measured by `Preflight` if available,
+        or estimated from its duration
+        '''
+
+        length = podcast.get('preflight', {}).get('length')
+        if length:
+            return length
+
+        return podcast['durationSeconds'] * 10 * 1024
+
+    @classmethod
+    def buffering(cls, podcast, throughput=None, cache_max=cache_max):
+        '''
+        Player buffering for a podcast, as a dict with:
+        - `cache`: cache size in KB, up to `cache_max`
+        - `prebuffer`: percentage of the cache to fill before starting to play
+
+        If the `throughput` (bytes per second) is lower than the audio bitrate, pre-buffer
+        the part of the audio which wouldn't arrive in time to be played without stalls.
+        '''
+
+        size = cls.audio_size(podcast)
+        cache = min(size, cache_max * 1024)
+        prebuffer = 1
+
+        bitrate = size / float(max(podcast['durationSeconds'], 1))
+        if throughput is not None and throughput < bitrate * cls.throughput_margin:
+            missing = size * (1 - throughput / (bitrate * cls.throughput_margin))
+            prebuffer = int(math.ceil(100. * missing / max(cache, 1)))
+
+        return {
+            'cache': int(math.ceil(cache / 1024.)),
+            'prebuffer': max(1, min(prebuffer, 99)),
+        }
+
+    @classmethod
+    def cache_size(cls, podcast):
+        '''Player cache size in KB: the one decided by `buffering`, or enough for all the podcast'''
+
+        if 'buffering' in podcast:
+            return podcast['buffering']['cache']
+
+        return int(math.ceil(cls.audio_size(podcast) / 1024.))
+
+    @classmethod
+    def cache_prebuffer(cls, podcast):
+        '''Percentage of the cache to fill before playing, as decided by `buffering`'''
+        return podcast.get('buffering', {}).get('prebuffer', 1)
+
+    def get_throughput(self, podcast):  # pylint: disable=unused-argument
+        '''
+        Throughput measured by previous downloads, by `Preflight` or `Prefetcher`,
+        or while playing the previous podcast, in background. Not measured here,
+        to not use the network between programs.
+        '''
+        return bandwidth.rate
+
+    def measure_throughput_while_playing(self, podcast):
+        '''
+        Measures throughput in background with the podcast being played, if there isn't
+        a recent measure, to size the next podcasts buffering
+        '''
+
+        if bandwidth.rate is not None:
+            return
+
+        def measure():
+            '''Ignore cancellation: main thread handles it'''
+            try:
+                refresh_throughput(podcast)
+            except ExceptionCancelled:
+                pass
+
+        self._throughput_thread = threading.Thread(target=measure)
+        self._throughput_thread.daemon = True
+        self._throughput_thread.start()
+
     def play_podcast(self, podcast):
         '''Play a podcast with an external command, or only print the command'''
 
+        # Size player buffers for this podcast and link
+        podcast['buffering'] = self.buffering(
+            podcast,
+            throughput=self.get_throughput(podcast),
+            cache_max=getattr(self.args, 'cache_max', self.cache_max))
+
         call_args = self.play_podcast_command_call_args(podcast)
 
         # Print URL?
@@ -666,60 +2083,97 @@ class PlayerCommand(object):
         # Listen with command
         # Use try to catch CTRL+C correctly
         try:
-            self._process = subprocess.call(call_args)
+            self._process = subprocess.Popen(call_args, **self.process_group_kwargs())
+            self.measure_throughput_while_playing(podcast)
+            self._process.wait()
             self._process = None
 
-        except subprocess.CalledProcessError as exc:
+        except OSError as exc:
             raise ExceptionPlayer(u"ERROR amb {command}: {error}".format(
                 command=self.command_name,
-                error=exc.output))
+                error=exc))
 
-    def signal_handler(self, sign, *_):  # Unused frame argument
-        '''Exits cleanly'''
+    @classmethod
+    def process_group_kwargs(cls):
+        '''
+        Popen arguments to run the player in its own process group, so it can be
+        stopped with all its childs. Only when not attached to a terminal, as the
+        player needs to stay in the terminal's foreground group to read keys.
+        '''
 
-        # Don't begin exit process more than once
-        if self._process_already_exiting:
-            return
+        if sys.stdin is not None and sys.stdin.isatty():
+            return {}
 
-        self._process_already_exiting = True
+        # `preexec_fn` is unsafe with threads running (preflight, prefetch, downloads)
+        if sys.version_info >= (3, 2):
+            return {'start_new_session': True}
 
-        # Flush stdout and wait until process exits completely
-        sys.stdout.flush()
-        print(u'CTRL-C!! Sortim! ({signal})'.format(signal=sign))
+        # Py2
+        return {'preexec_fn': os.setpgrp}
+
+    @staticmethod
+    def process_exited(process):
+        '''
+        Whether a process has exited. Reaps it directly, as `Popen.poll` can't
+        while `Popen.wait` is interrupted by a signal handler.
+        '''
+
+        if process.returncode is not None:
+            return True
+
+        try:
+            pid, _ = os.waitpid(process.pid, os.WNOHANG)
+        except OSError as exc:
+            if exc.errno != errno.ECHILD:
+                raise
+            return True
 
-        # Wait a second...
-        import time
-        time.sleep(1)
+        return pid != 0
 
-        # If mplayer process is defined
-        if self._process is not None:
-            print(u"Waiting for {command} to finish...".format(
-                command=self.command_name))
+    def stop_process(self, deadline=None):
+        '''Stops the player, killing it if it doesn't exit within `deadline` seconds'''
 
-            import psutil
+        process = self._process
+        if process is None or self.process_exited(process):
+            return
 
+        deadline = self.shutdown_deadline if deadline is None else deadline
+        for sign in (signal.SIGTERM, signal.SIGKILL):
             try:
-                # Get process info
-                process = psutil.Process(self._process)
+                # Signal the whole process group if the player has its own
+                if os.getpgid(process.pid) == process.pid:
+                    os.killpg(process.pid, sign)
+                else:
+                    os.kill(process.pid, sign)
+            except OSError as exc:
+                if exc.errno != errno.ESRCH:
+                    raise
+                return
+
+            limit = time.time() + deadline
+            while time.time() < limit:
+                if self.process_exited(process):
+                    return
+                time.sleep(0.05)
 
-                print(u"Killing {command} and all possible childs.".format(
-                    command=self.command_name))
+            print(u"Killing {command}.".format(command=self.command_name))
 
-                # Kill process childs and wait for them to exit completely
-                for proc in process.children(recursive=True):
-                    proc.send_signal(signal.SIGTERM)
-                    proc.wait()
+    def signal_handler(self, sign, *_):  # Unused frame argument
+        '''Exits cleanly within `shutdown_deadline` seconds'''
+
+        # Don't begin exit process more than once
+        if self._process_already_exiting:
+            return
 
-                # Kill process and wait for it to exit completely
-                process.send_signal(signal.SIGTERM)
-                process.wait()
+        self._process_already_exiting = True
 
-            except psutil.NoSuchProcess:
-                print(u"{command} already ended.".format(
-                    command=self.command_name))
+        # Flush stdout
+        sys.stdout.flush()
+        print(u'CTRL-C!! Sortim! ({signal})'.format(signal=sign))
 
-        # Reset terminal
-        # subprocess.Popen(['reset']).wait()
+        # Stop HTTP requests, background work and the player
+        cancellation.cancel()
+        self.stop_process()
 
         # If we are handling signal, we can exit program
         exit(3)
@@ -734,18 +2188,239 @@ class MPlayerCommand(PlayerCommand):
     def play_podcast_command_call_args(cls, podcast):
         '''Creates the calling array for playing a podcast with MPlayer'''
 
-        # Cache:
-        #  - Try to play as soon as possible (with `-cache-min`)
-        #  - Try to download full podcast from the beginning, aka full cache (with `-cache`)
+        # Cache (see `PlayerCommand.buffering`):
+        #  - Try to play as soon as the link allows it (with `-cache-min`)
+        #  - Try to download as much podcast as memory allows (with `-cache`)
         return [
             "mplayer",
-            "-cache-min", "1",
-            "-cache", str(podcast['durationSeconds'] * 10),
+            "-cache-min", str(cls.cache_prebuffer(podcast)),
+            "-cache", str(cls.cache_size(podcast)),
             "-ss", str(podcast['start']),
             podcast['path']
         ]
 
 
+class Profiler(object):
+    '''
+    Class to profile CPU (with cProfile) and memory allocations (with tracemalloc)
+    of named phases, and dump the reports to a directory. Does nothing if no directory is given.
+
+    Can be used as a context manager to profile a whole block as the `main` phase:
+
+        with Profiler('/tmp/rac1-profile') as profiler:
+            for podcast in profiler.iterate(Filter(), 'filter'):
+                with profiler.phase('player'):
+                    ...
+
+    cProfile only profiles the thread which enables it, so background threads have to
+    run their work in their own phases (see `Prefetcher` and `Downloader`), which are
+    accumulated with the same name ones of other threads. On Py3.12+, only one thread
+    can be CPU profiled at a time: phases started while another one is being profiled
+    only report allocations. Allocations are traced process wide, so phases running
+    concurrently include each other's allocations.
+    '''
+
+    # Directory where reports are saved
+    directory = None
+
+    # Number of entries shown in text reports
+    top = 20
+
+    def __init__(self, directory=None, top=top):
+        self.directory = directory
+        self.top = top
+
+        # Accumulated cProfile.Profile by (phase name, thread), and allocation sizes by phase name
+        self._profiles = {}
+        self._allocations = {}
+        self._lock = threading.Lock()
+
+        # Currently running phases by thread
+        self._local = threading.local()
+
+        self._tracemalloc = None
+        self._main = None
+
+    @property
+    def enabled(self):
+        '''Whether profiling is enabled'''
+        return self.directory is not None
+
+    @property
+    def _stack(self):
+        '''Currently running phases in this thread, as (name, profile) tuples'''
+
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+
+        return self._local.stack
+
+    @staticmethod
+    def _enable(profile):
+        '''Enables a profile, returning it, or None if another one is active (Py3.12+)'''
+
+        try:
+            profile.enable()
+        except ValueError:
+            return None
+
+        return profile
+
+    def __enter__(self):
+        if self.enabled:
+
+            # Memory allocation tracing is only available on Py3
+            try:
+                import tracemalloc
+            except ImportError:
+                print(u"### tracemalloc no disponible: només es perfila la CPU")
+            else:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._tracemalloc = tracemalloc
+
+            self._main = self.phase('main')
+            self._main.__enter__()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            self._main.__exit__(*exc_info)
+            self.dump()
+
+            if self._tracemalloc is not None:
+                self._tracemalloc.stop()
+                self._tracemalloc = None
+
+    def take_snapshot(self):
+        '''Memory snapshot without tracemalloc's own allocations, or None if not tracing'''
+
+        if self._tracemalloc is None:
+            return None
+
+        return self._tracemalloc.take_snapshot().filter_traces((
+            self._tracemalloc.Filter(False, self._tracemalloc.__file__),
+        ))
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Context manager which profiles its block as phase `name`.
+        Repeated phases are accumulated. Nested phases pause the CPU profiling
+        of their parent, but parent's allocations include its nested phases ones.
+        '''
+
+        if not self.enabled:
+            yield
+            return
+
+        import cProfile
+
+        key = (name, threading.current_thread().ident)
+        with self._lock:
+            if key not in self._profiles:
+                self._profiles[key] = cProfile.Profile()
+            profile = self._profiles[key]
+
+        # Pause parent phase
+        stack = self._stack
+        if stack and stack[-1][1] is not None:
+            stack[-1][1].disable()
+
+        snapshot = self.take_snapshot()
+        stack.append((name, self._enable(profile)))
+
+        try:
+            yield
+
+        finally:
+            if stack.pop()[1] is not None:
+                profile.disable()
+
+            if snapshot is not None:
+                self.add_allocations(name, snapshot, self.take_snapshot())
+
+            # Resume parent phase
+            if stack and stack[-1][1] is not None:
+                stack[-1] = (stack[-1][0], self._enable(stack[-1][1]))
+
+    def add_allocations(self, name, before, after):
+        '''Accumulates allocated memory by source line between two snapshots'''
+
+        stats = after.compare_to(before, 'lineno')
+
+        with self._lock:
+            allocations = self._allocations.setdefault(name, {})
+            for stat in stats:
+                line = str(stat.traceback)
+                size, count = allocations.get(line, (0, 0))
+                allocations[line] = (size + stat.size_diff, count + stat.count_diff)
+
+    def iterate(self, iterable, name):
+        '''Iterates over `iterable`, profiling each item retrieval as phase `name`'''
+
+        if not self.enabled:
+            return iter(iterable)
+
+        return self._iterate(iter(iterable), name)
+
+    def _iterate(self, iterator, name):
+        '''Generator implementation for `iterate`'''
+
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+
+            yield item
+
+    def dump(self):
+        '''
+        Saves reports for each phase into directory:
+        - `{phase}.pstats`: binary stats, to be loaded with `pstats` or visualizers
+        - `{phase}.txt`: top functions by cumulative time
+        - `{phase}.allocations.txt`: top source lines by allocated memory (Py3 only)
+        '''
+
+        import pstats
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Merge each phase profiles from all threads
+        phases = {}
+        for (name, _), profile in self._profiles.items():
+            profile.create_stats()
+            if not profile.stats:
+                continue
+
+            if name in phases:
+                phases[name].add(profile)
+            else:
+                phases[name] = pstats.Stats(profile)
+
+        for name, stats in phases.items():
+            path = os.path.join(self.directory, name)
+            stats.dump_stats(path + '.pstats')
+
+            with open(path + '.txt', 'w') as report:
+                stats.stream = report
+                stats.sort_stats('cumulative').print_stats(self.top)
+
+        for name, allocations in self._allocations.items():
+            lines = sorted(allocations.items(), key=lambda item: item[1][0], reverse=True)
+
+            with open(os.path.join(self.directory, name + '.allocations.txt'), 'w') as report:
+                report.write(u"{:>12} {:>10}  {}\n".format("KiB", "blocks", "line"))
+                for line, (size, count) in lines[:self.top]:
+                    report.write(u"{:>12.1f} {:>10}  {}\n".format(size / 1024., count, line))
+
+        print(u"### Informes de perfil desats a {directory}".format(directory=self.directory))
+
+
 def main(argv=None, filter_class=Filter, parser_class=Parser, player_class=MPlayerCommand):
     '''Parses arguments, gets podcasts list and play its items according to arguments'''
 
@@ -758,29 +2433,72 @@ def main(argv=None, filter_class=Filter, parser_class=Parser, player_class=MPlay
     # Instantiate player class
     player = player_class(args=args)
 
-    # Borrow SIGINT to exit cleanly and disable stdout buffering
+    # Borrow SIGINT and SIGTERM to exit cleanly
+    cancellation.reset()
     signal.signal(signal.SIGINT, player.signal_handler)
+    signal.signal(signal.SIGTERM, player.signal_handler)
 
-    # Get and play list of podcasts:
-    #  - Playing with mplayer (done via play_podcast)
-    #  - Handling two possible expected Exceptions to exit cleanly
-    try:
-        # Iterate over autoreloaded podcasts generator
-        for podcast in rac1:
+    # Measure throughput in background for players, if playing
+    playing = not (args.only_print or args.only_print_url or args.download)
 
+    # Optionally, profile CPU and allocations of podcasts retrieval and playing
+    profiler = Profiler(args.profile)
+
+    # Optionally, retrieve next podcasts in background while playing
+    podcasts = rac1
+    if args.prefetch > 0:
+        podcasts = Prefetcher(podcasts, size=args.prefetch,
+                              throughput=playing and not args.preflight, profiler=profiler)
+
+    # Optionally, check audio URLs in background before playing them
+    if args.preflight:
+        podcasts = Preflight(podcasts, ahead=args.preflight_ahead, throughput=playing,
+                             profiler=profiler)
+
+    with profiler:
+
+        # Download podcasts audio instead of playing them
+        if args.download:
             try:
-                # Play podcast or only print command or URL
-                player.play_podcast(podcast)
+                with profiler.phase('download'):
+                    Downloader(args=args, profiler=profiler).download_podcasts(podcasts)
 
-            except ExceptionPlayer as exc:
-                # Exit with error return value 2 on error playing
+            except ExceptionDownloading as exc:
+                # Exit with error return value 1 on error downloading
                 print(exc)
-                return 2
+                return 1
 
-    except ExceptionDownloading as exc:
-        # Exit with error return value 1 on error downloading
-        print(exc)
-        return 1
+            except ExceptionCancelled:
+                # Exit with return value 3, as on signals
+                return 3
+
+            return 0
+
+        # Get and play list of podcasts:
+        #  - Playing with mplayer (done via play_podcast)
+        #  - Handling two possible expected Exceptions to exit cleanly
+        try:
+            # Iterate over autoreloaded podcasts generator
+            for podcast in profiler.iterate(podcasts, 'filter'):
+
+                try:
+                    # Play podcast or only print command or URL
+                    with profiler.phase('player'):
+                        player.play_podcast(podcast)
+
+                except ExceptionPlayer as exc:
+                    # Exit with error return value 2 on error playing
+                    print(exc)
+                    return 2
+
+        except ExceptionDownloading as exc:
+            # Exit with error return value 1 on error downloading
+            print(exc)
+            return 1
+
+        except ExceptionCancelled:
+            # Exit with return value 3, as on signals
+            return 3
 
     return 0
 
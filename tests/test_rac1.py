@@ -1,8 +1,604 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
+
+import pytest
+
 import Rac1
 
 
 def test_dummy():
     assert 1 == 1, 'Dummy test'
+
+
+def make_podcast(hour, path=None, duration=3600):
+    '''Builds a minimal podcast as returned by `Parser.get_podcast_data`'''
+    return {
+        'path': path or 'https://audio.example/{}.mp3'.format(hour),
+        'durationSeconds': duration,
+        'start': 0,
+        'audio': {
+            'title': u'PROGRAMA {}'.format(hour),
+            'hour': hour,
+            'time': u'{:02d}:00'.format(hour),
+            'date': u'2018-10-20',
+            'id': u'uuid-{}'.format(hour),
+        },
+    }
+
+
+def test_preflight_skips_broken_urls(monkeypatch):
+    def fake_probe(url, timeout=10):
+        broken = url.endswith('/9.mp3')
+        return {
+            'ok': not broken,
+            'status': 404 if broken else 200,
+            'latency': 0.01,
+            'length': None if broken else 2048000,
+            'error': None,
+        }
+
+    monkeypatch.setattr(Rac1, 'probe_url', fake_probe)
+
+    podcasts = list(Rac1.Preflight([make_podcast(hour) for hour in (8, 9, 10)], ahead=2))
+
+    assert [podcast['audio']['hour'] for podcast in podcasts] == [8, 10]
+    assert podcasts[0]['preflight']['length'] == 2048000
+    assert Rac1.MPlayerCommand.cache_size(podcasts[0]) == 2000
+
+
+def test_profiler_dumps_reports_per_phase(tmpdir):
+    directory = str(tmpdir.join('profile'))
+
+    with Rac1.Profiler(directory, top=5) as profiler:
+        for hour in profiler.iterate(range(3), 'filter'):
+            with profiler.phase('player'):
+                Rac1.normalize_encoding_upper(u'Què t\'hi jugues {}'.format(hour))
+
+    files = set(tmpdir.join('profile').listdir())
+    for phase in ('main', 'filter', 'player'):
+        assert tmpdir.join('profile', phase + '.pstats') in files
+        assert tmpdir.join('profile', phase + '.txt') in files
+        assert tmpdir.join('profile', phase + '.allocations.txt') in files
+
+
+def test_profiler_profiles_background_threads(tmpdir):
+    directory = str(tmpdir.join('profile'))
+
+    def source():
+        for hour in range(8, 11):
+            yield Rac1.normalize_encoding_upper(u'Què t\'hi jugues {}'.format(hour))
+
+    with Rac1.Profiler(directory, top=5) as profiler:
+        assert len(list(Rac1.Prefetcher(source(), size=1, profiler=profiler))) == 3
+
+    files = set(tmpdir.join('profile').listdir())
+    for report in ('.pstats', '.txt', '.allocations.txt'):
+        assert tmpdir.join('profile', 'prefetch' + report) in files
+    assert '(source)' in tmpdir.join('profile', 'prefetch.txt').read()
+
+
+def test_profiler_disabled_is_passthrough():
+    profiler = Rac1.Profiler()
+    items = [1, 2]
+
+    with profiler:
+        assert list(profiler.iterate(items, 'filter')) == items
+        with profiler.phase('player'):
+            pass
+
+
+def test_prefetcher_keeps_order_with_backpressure():
+    pulled = []
+
+    def source():
+        for hour in range(8, 18):
+            pulled.append(hour)
+            yield make_podcast(hour)
+
+    prefetcher = Rac1.Prefetcher(source(), size=1)
+    assert next(prefetcher)['audio']['hour'] == 8
+
+    # One queued, one waiting to be queued
+    time.sleep(0.3)
+    assert len(pulled) <= 3
+
+    assert [podcast['audio']['hour'] for podcast in prefetcher] == list(range(9, 18))
+
+
+def test_prefetcher_propagates_errors():
+    def source():
+        yield make_podcast(8)
+        raise Rac1.ExceptionDownloading(u'Error')
+
+    prefetcher = Rac1.Prefetcher(source(), size=2)
+    assert next(prefetcher)['audio']['hour'] == 8
+    with pytest.raises(Rac1.ExceptionDownloading):
+        next(prefetcher)
+
+
+def test_main_prefetch_maps_download_errors_to_exit_code():
+    class FailingParser(Rac1.Parser):
+        def get_podcasts(self):
+            raise Rac1.ExceptionDownloading(u'Error')
+            yield  # pylint: disable=unreachable
+
+    assert Rac1.main(['--prefetch', '2', '-u'], parser_class=FailingParser) == 1
+
+
+class FakeResponse(object):
+    '''Minimal streamed `requests` response serving a byte range of `data`'''
+
+    def __init__(self, data, start=0, end=None):
+        self.status_code = 200 if end is None else 206
+        self.content = data[start:] if end is None else data[start:end + 1]
+
+    def iter_content(self, chunk_size):
+        for offset in range(0, len(self.content), chunk_size):
+            yield self.content[offset:offset + chunk_size]
+
+    def close(self):
+        pass
+
+
+def fake_downloads(monkeypatch, data, fail_from=None):
+    '''Serves `data` to Downloader, failing mid-segment for ranges from `fail_from`'''
+
+    ranges = []
+
+    def fake_get(url, headers=None, **_):
+        start, end = [int(value) for value in headers['Range'].split('=')[1].split('-')]
+        ranges.append((start, end))
+        response = FakeResponse(data, start, end)
+
+        if fail_from is not None and start >= fail_from:
+            def interrupted(chunk_size):
+                yield response.content[:chunk_size]
+                raise IOError('Connection lost')
+            response.iter_content = interrupted
+
+        return response
+
+    monkeypatch.setattr(Rac1, 'probe_url', lambda url, timeout=10: {
+        'ok': True, 'status': 206, 'latency': 0.01,
+        'length': len(data), 'ranges': True, 'error': None})
+    monkeypatch.setattr(Rac1.requests, 'get', fake_get)
+
+    return ranges
+
+
+def make_downloader(tmpdir, connections):
+    '''Downloader into `tmpdir` with small segments'''
+
+    args = Rac1.configargparse.Namespace(
+        download=str(tmpdir), download_connections=connections, download_rate=0)
+    downloader = Rac1.Downloader(args=args)
+    downloader.segment_size = 1000
+
+    return downloader
+
+
+def test_downloader_segments_resume_and_join(monkeypatch, tmpdir):
+    data = bytes(bytearray(range(256))) * 14
+    ranges = fake_downloads(monkeypatch, data)
+    downloader = make_downloader(tmpdir, 3)
+
+    podcast = make_podcast(8, duration=1)
+    path = downloader.filename(podcast)
+    assert Rac1.Downloader.plan_segments(len(data), 3, 1000) == [
+        (0, 1194), (1195, 2389), (2390, 3583)]
+
+    # Resume first segment from a partial download
+    with open(path + '.part0-1194of3584', 'wb') as part:
+        part.write(data[:100])
+
+    downloader.download_podcasts([podcast])
+
+    with open(path, 'rb') as output:
+        assert output.read() == data
+    assert sorted(ranges) == [(100, 1194), (1195, 2389), (2390, 3583)]
+    assert tmpdir.listdir() == [tmpdir.join('2018-10-20_08h_8.mp3')]
+
+
+def test_downloader_resume_with_other_connections_count(monkeypatch, tmpdir):
+    data = bytes(bytearray(range(256))) * 14
+    podcast = make_podcast(8, duration=1)
+
+    # Interrupted download with 2 connections: second segment is partial
+    fake_downloads(monkeypatch, data, fail_from=1000)
+    with pytest.raises(Rac1.ExceptionDownloading):
+        make_downloader(tmpdir, 2).download_podcasts([podcast])
+    assert len(tmpdir.listdir()) == 2
+
+    # Resumed with 3 connections: other plan parts can't be reused
+    fake_downloads(monkeypatch, data)
+    downloader = make_downloader(tmpdir, 3)
+    downloader.download_podcasts([podcast])
+
+    with open(downloader.filename(podcast), 'rb') as output:
+        assert output.read() == data
+    assert tmpdir.listdir() == [tmpdir.join('2018-10-20_08h_8.mp3')]
+
+
+def test_buffering_depends_on_throughput():
+    # 128 kbps, one hour
+    podcast = make_podcast(8)
+    podcast['preflight'] = {'length': 16000 * 3600}
+
+    fast = Rac1.PlayerCommand.buffering(podcast, throughput=1000000, cache_max=8192)
+    assert fast == {'cache': 8192, 'prebuffer': 1}
+
+    unknown = Rac1.PlayerCommand.buffering(podcast, cache_max=8192)
+    assert unknown == fast
+
+    slow = Rac1.PlayerCommand.buffering(podcast, throughput=16000, cache_max=65536)
+    assert slow['cache'] == 56250
+    assert 1 < slow['prebuffer'] < 99
+
+    podcast['buffering'] = slow
+    call_args = Rac1.MPlayerCommand.play_podcast_command_call_args(podcast)
+    assert call_args[1:5] == ['-cache-min', str(slow['prebuffer']), '-cache', '56250']
+
+
+def test_filter_follow_waits_for_new_hours(monkeypatch):
+    # Don't depend on the time the test is run
+    monkeypatch.setattr(Rac1.PublishPredictor, 'max_delay', 48 * 3600)
+    monkeypatch.setattr(Rac1.PublishPredictor, 'late_backoff', 48 * 3600)
+
+    today = time.strftime('%Y-%m-%d')
+    published = [make_podcast(8)]
+    changes = [False, Rac1.ExceptionDownloading('Timeout'), True]
+
+    class FakeParser(object):
+        def __call__(self):
+            for podcast in published:
+                podcast['audio']['date'] = today
+                yield dict(podcast)
+
+        def listing_changed(self):
+            changed = changes.pop(0)
+            if isinstance(changed, Exception):
+                raise changed
+            if changed:
+                published.append(make_podcast(9))
+            return changed
+
+    args = Rac1.configargparse.Namespace(
+        date=time.strftime('%d/%m/%Y'), from_hour=8, to_hour=9, excludes=[],
+        start_first=0, only_print=False, only_print_url=True, download=None, follow=True)
+    rac1 = Rac1.Filter(args=args, parser=FakeParser())
+    sleeps = []
+    monkeypatch.setattr(rac1, 'sleep', sleeps.append)
+
+    assert [podcast['audio']['hour'] for podcast in rac1] == [8, 9]
+    # Poll again soon after a miss, back off after an error
+    min_poll = Rac1.PublishPredictor.min_poll
+    assert changes == []
+    assert sleeps[-2:] == [min_poll, 2 * min_poll]
+
+
+def test_publish_predictor_learns_delay():
+    predictor = Rac1.PublishPredictor()
+    podcast = make_podcast(8)
+    end = Rac1.PublishPredictor.program_end(podcast)
+
+    predictor.learn(podcast, end + 100)
+    assert predictor.delay == 200
+    assert predictor.expected(podcast, None, None) == end + 3600 + 200
+
+    # Archived podcasts don't change the delay
+    predictor.learn(podcast, end + 24 * 3600)
+    assert predictor.delay == 200
+
+
+def test_publish_predictor_backs_off_only_when_long_late_or_failing():
+    predictor = Rac1.PublishPredictor()
+
+    assert predictor.poll_interval(-30) == predictor.min_poll
+    assert predictor.poll_interval(predictor.late_backoff - 1) == predictor.min_poll
+    assert predictor.poll_interval(predictor.late_backoff) == 2 * predictor.min_poll
+    assert predictor.poll_interval(0, errors=2) == 4 * predictor.min_poll
+    assert predictor.poll_interval(0, errors=10) == predictor.max_poll
+
+
+SHUTDOWN_SCRIPT = '''
+import sys
+import time
+import Rac1
+
+
+class SleepPlayer(Rac1.PlayerCommand):
+    @classmethod
+    def play_podcast_command_call_args(cls, podcast):
+        # Ignore SIGTERM, to be killed after the deadline
+        return ["sh", "-c", "trap '' TERM; sleep 30"]
+
+
+class OnePodcastFilter(object):
+    def __init__(self, args, parser):
+        pass
+
+    def __iter__(self):
+        podcast = {"path": "x", "durationSeconds": 1, "audio": {"title": "T", "hour": 8}}
+        podcast["preflight"] = {"length": 1}
+        yield podcast
+
+
+Rac1.bandwidth.add(1, 1)
+Rac1.PlayerCommand.shutdown_deadline = 0.5
+sys.exit(Rac1.main([], filter_class=OnePodcastFilter, player_class=SleepPlayer))
+'''
+
+
+def test_signal_exit_latency_is_bounded(tmpdir):
+    import os
+    import signal
+    import subprocess
+    import sys
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    process = subprocess.Popen([sys.executable, '-c', SHUTDOWN_SCRIPT], env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               cwd=str(tmpdir))
+
+    # Wait for the player to start
+    time.sleep(1)
+    start = time.time()
+    process.send_signal(signal.SIGTERM)
+    process.communicate()
+    latency = time.time() - start
+
+    assert process.returncode == 3
+    # SIGTERM ignored by the player: SIGKILL after the deadline
+    assert latency < 0.5 + 0.5
+
+
+def test_catalog_roundtrip_and_query(tmpdir):
+    path = str(tmpdir.join('catalog.bin'))
+    podcasts = [make_podcast(hour) for hour in range(6, 15)]
+    podcasts[3]['audio']['title'] = u'Què t\'hi jugues'
+    podcasts.append(make_podcast(10))
+    podcasts[-1]['audio']['date'] = u'2018-10-21'
+
+    assert Rac1.Catalog.write(path, podcasts) == len(podcasts)
+
+    with Rac1.Catalog(path) as catalog:
+        assert len(catalog) == len(podcasts)
+        expected = make_podcast(6)
+        del expected['start']
+        assert catalog.get_podcast(0) == expected
+
+        excludes = ['12', Rac1.normalize_encoding_upper(u'QUE T\'HI')]
+        hours = [podcast['audio']['hour'] for podcast in catalog.get_podcasts(
+            date=u'20/10/2018', from_hour=8, to_hour=14, excludes=excludes)]
+        assert hours == [8, 10, 11, 13, 14]
+        assert list(catalog.query(date=u'21/10/2018')) == [len(podcasts) - 1]
+
+
+def test_catalog_copied_columns(monkeypatch, tmpdir):
+    path = str(tmpdir.join('catalog.bin'))
+    Rac1.Catalog.write(path, [make_podcast(hour) for hour in (8, 9)])
+
+    # Force the copy used on Py2 and big endian hosts
+    monkeypatch.setattr(Rac1.Catalog, 'mapped_columns', False)
+
+    with Rac1.Catalog(path) as catalog:
+        assert [podcast['audio']['hour'] for podcast in catalog.get_podcasts()] == [8, 9]
+
+
+def follow_filter(to_hour, excludes=()):
+    '''Following Filter for today which has published the 8h podcast, and won't publish more'''
+
+    today = time.strftime('%Y-%m-%d')
+    polls = []
+
+    class FakeParser(object):
+        def __call__(self):
+            podcast = make_podcast(8)
+            podcast['audio']['date'] = today
+            yield podcast
+
+        def listing_changed(self):
+            polls.append(time.time())
+            return False
+
+    args = Rac1.configargparse.Namespace(
+        date=time.strftime('%d/%m/%Y'), from_hour=8, to_hour=to_hour, excludes=list(excludes),
+        start_first=0, only_print=False, only_print_url=True, download=None, follow=True)
+    rac1 = Rac1.Filter(args=args, parser=FakeParser())
+    rac1.sleep = lambda seconds: None
+
+    return rac1, polls
+
+
+def test_filter_follow_stops_without_pending_hours():
+    rac1, polls = follow_filter(to_hour=9, excludes=[b'9'])
+    assert [podcast['audio']['hour'] for podcast in rac1] == [8]
+    assert polls == []
+
+
+def test_filter_follow_stops_after_deadline(monkeypatch):
+    monkeypatch.setattr(Rac1.PublishPredictor, 'max_delay', -48 * 3600)
+    rac1, polls = follow_filter(to_hour=10)
+    assert [podcast['audio']['hour'] for podcast in rac1] == [8]
+    assert polls == []
+
+
+def test_prefetcher_reloads_after_last_podcast_is_played():
+    published = [make_podcast(8), make_podcast(9)]
+
+    class FakeParser(object):
+        def __call__(self):
+            for podcast in published:
+                yield dict(podcast)
+
+    args = Rac1.configargparse.Namespace(
+        date=u'20/10/2018', from_hour=8, to_hour=14, excludes=[], start_first=0,
+        only_print=False, only_print_url=False, download=None, follow=False)
+    prefetcher = Rac1.Prefetcher(Rac1.Filter(args=args, parser=FakeParser()), size=2)
+
+    played = []
+    for podcast in prefetcher:
+        played.append(podcast['audio']['hour'])
+
+        # Next hour is published while the last listed one is being played
+        if podcast['audio']['hour'] == 9:
+            time.sleep(0.3)
+            published.append(make_podcast(10))
+
+    assert played == [8, 9, 10]
+
+
+@pytest.mark.parametrize('pipeline', [
+    lambda podcasts: Rac1.Preflight(podcasts, ahead=2),
+    lambda podcasts: Rac1.Preflight(Rac1.Prefetcher(podcasts, size=2), ahead=2),
+], ids=['preflight', 'prefetch-preflight'])
+def test_preflight_reloads_after_last_podcast_is_played(monkeypatch, pipeline):
+    monkeypatch.setattr(Rac1, 'probe_url', lambda url, timeout=10: {
+        'ok': True, 'status': 200, 'latency': 0.01, 'length': 2048000, 'error': None})
+
+    published = [make_podcast(8), make_podcast(9)]
+
+    class FakeParser(object):
+        def __call__(self):
+            for podcast in published:
+                yield dict(podcast)
+
+    args = Rac1.configargparse.Namespace(
+        date=u'20/10/2018', from_hour=8, to_hour=14, excludes=[], start_first=0,
+        only_print=False, only_print_url=False, download=None, follow=False)
+
+    played = []
+    for podcast in pipeline(Rac1.Filter(args=args, parser=FakeParser())):
+        played.append(podcast['audio']['hour'])
+
+        # Next hour is published while the last listed one is being played
+        if podcast['audio']['hour'] == 9:
+            time.sleep(0.3)
+            published.append(make_podcast(10))
+
+    assert played == [8, 9, 10]
+
+
+def test_prefetcher_reloads_while_last_podcast_is_played():
+    published = [make_podcast(8), make_podcast(9)]
+    loads = []
+
+    class FakeParser(object):
+        def __call__(self):
+            loads.append(len(published))
+            for podcast in published:
+                yield dict(podcast)
+
+    args = Rac1.configargparse.Namespace(
+        date=u'20/10/2018', from_hour=8, to_hour=14, excludes=[], start_first=0,
+        only_print=False, only_print_url=False, download=None, follow=False)
+    prefetcher = Rac1.Prefetcher(Rac1.Filter(args=args, parser=FakeParser()), size=2)
+
+    played = []
+    for podcast in prefetcher:
+        played.append(podcast['audio']['hour'])
+
+        # Next hour is already published when the last listed one starts playing
+        if podcast['audio']['hour'] == 8:
+            published.append(make_podcast(10))
+        elif podcast['audio']['hour'] == 9:
+            time.sleep(0.3)
+            assert loads == [2, 3]
+
+    # While playing 10, reload finds nothing: only then, a last one once drained
+    assert played == [8, 9, 10]
+    assert loads == [2, 3, 3, 3]
+
+
+def test_measure_throughput_reads_only_ranged_size(monkeypatch):
+    data = b'x' * (1024 * 1024)
+    responses = []
+
+    def fake_get(url, headers=None, **_):
+        response = FakeResponse(data) if url == 'full' else FakeResponse(data, 0, len(data) - 1)
+        response.chunks = 0
+        iter_content = response.iter_content
+
+        def counted(chunk_size):
+            for chunk in iter_content(chunk_size):
+                response.chunks += 1
+                yield chunk
+
+        response.iter_content = counted
+        responses.append(response)
+        return response
+
+    monkeypatch.setattr(Rac1, 'bandwidth', Rac1.BandwidthMeter())
+    monkeypatch.setattr(Rac1.requests, 'get', fake_get)
+
+    # Range ignored: not read nor measured
+    assert Rac1.measure_throughput('full', size=256 * 1024) is None
+    assert responses[-1].chunks == 0
+
+    # Stop at the requested size, even if the server sends more
+    assert Rac1.measure_throughput('ranged', size=256 * 1024) is not None
+    assert responses[-1].chunks == 4
+
+
+def test_player_doesnt_probe_between_programs(monkeypatch):
+    monkeypatch.setattr(Rac1, 'bandwidth', Rac1.BandwidthMeter())
+    monkeypatch.setattr(Rac1, 'measure_throughput', lambda *_: pytest.fail('Probed'))
+
+    assert Rac1.PlayerCommand().get_throughput(make_podcast(8)) is None
+
+    # A measure taken one program ago is still used
+    Rac1.bandwidth.add(1000, 1)
+    Rac1.bandwidth._time -= 3600  # pylint: disable=protected-access
+    assert Rac1.PlayerCommand().get_throughput(make_podcast(9)) == 1000
+
+
+class TruePlayer(Rac1.PlayerCommand):
+    @classmethod
+    def play_podcast_command_call_args(cls, podcast):
+        return ["true"]
+
+
+def test_player_measures_throughput_while_playing(monkeypatch):
+    monkeypatch.setattr(Rac1, 'bandwidth', Rac1.BandwidthMeter())
+    measured = []
+
+    def fake_measure(url, **_):
+        measured.append(url)
+        # Slower than the audio bitrate
+        Rac1.bandwidth.add(5 * 1024, 1)
+        return Rac1.bandwidth.rate
+
+    monkeypatch.setattr(Rac1, 'measure_throughput', fake_measure)
+    player = TruePlayer()
+
+    # No measure yet: measured in background while playing
+    first = make_podcast(8)
+    player.play_podcast(first)
+    player._throughput_thread.join()  # pylint: disable=protected-access
+    assert measured == [first['path']]
+    assert first['buffering']['prebuffer'] == 1
+
+    # Next podcast uses it, and doesn't measure again
+    second = make_podcast(9)
+    player.play_podcast(second)
+    assert measured == [first['path']]
+    assert second['buffering']['prebuffer'] > 1
+
+
+def test_library_namespaces_without_new_options(capsys):
+    # Arguments as built by library users before the options were added
+    args = Rac1.configargparse.Namespace(
+        date=u'20/10/2018', from_hour=8, to_hour=14, excludes=[], start_first=0,
+        only_print=False, only_print_url=True)
+
+    class FakeParser(object):
+        def __call__(self):
+            yield make_podcast(8)
+
+    player = Rac1.MPlayerCommand(args=args)
+    for podcast in Rac1.Filter(args=args, parser=FakeParser()):
+        player.play_podcast(podcast)
+
+    assert capsys.readouterr().out.endswith('https://audio.example/8.mp3\n')